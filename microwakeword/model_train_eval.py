@@ -199,6 +199,12 @@ if __name__ == "__main__":
     with open(os.path.join(config["train_dir"], "flags.json"), "wt") as f:
         json.dump(flags.__dict__, f)
 
+    export_streaming = (
+        flags.test_tflite_streaming or flags.test_tflite_streaming_quantized
+    )
+
+    # Export all SavedModels before testing, so the trained model is loaded once
+    # and released before the tests run
     if flags.test_tf_nonstreaming or flags.test_tflite_nonstreaming:
         # Save the nonstreaming model to disk
         logging.info("Saving nonstreaming model")
@@ -209,6 +215,19 @@ if __name__ == "__main__":
             "non_stream",
             modes.Modes.NON_STREAM_INFERENCE,
             weights_name="best_weights",
+            keep_model=export_streaming,
+        )
+
+    if export_streaming:
+        # Save the internal streaming model to disk
+        logging.info("Saving streaming model")
+
+        utils.convert_model_saved(
+            flags,
+            config,
+            "stream_state_internal",
+            modes.Modes.STREAM_INTERNAL_STATE_INFERENCE,
+            weights_name="best_weights",
         )
 
     if flags.test_tf_nonstreaming:
@@ -237,18 +256,6 @@ if __name__ == "__main__":
             config, folder_name, data_processor, tflite_model_name=file_name
         )
 
-    if flags.test_tflite_streaming or flags.test_tflite_streaming_quantized:
-        # Save the internal streaming model to disk
-        logging.info("Saving streaming model")
-
-        utils.convert_model_saved(
-            flags,
-            config,
-            "stream_state_internal",
-            modes.Modes.STREAM_INTERNAL_STATE_INFERENCE,
-            weights_name="best_weights",
-        )
-
     if flags.test_tflite_streaming:
         # Convert the internal streaming model to TFLite then test it
         logging.info("Converting streaming model (non-quantized) to TFLite")
@@ -15,38 +15,60 @@
 # limitations under the License.
 
 """Utility functions for operations on Model."""
+import argparse
+import functools
+import gc
+import json
 import os.path
+import weakref
 import numpy as np
-import tensorflow as tf
 
 from absl import logging
-from typing import Sequence
-
-import microwakeword.inception as inception
+from collections import deque
 
 from microwakeword.layers import modes
 
+# Layer attributes which _set_mode changes for inference
+_MODE_ATTRIBUTES = ("mode", "training", "unroll")
+
+# Number of training spectrograms used to calibrate the quantized TFLite model
+REPRESENTATIVE_CLIP_COUNT = 500
+
+# Calibration frames keyed by audio_processor, then by spectrogram_length. Entries
+# are dropped together with the audio processor.
+_REPRESENTATIVE_FRAMES_CACHE = weakref.WeakKeyDictionary()
 
-def _set_mode(model, mode):
-    """Set model's inference type and disable training."""
 
-    def _recursive_set_layer_mode(layer, mode):
+def _iter_layers(model):
+    """Yields model's layers and the layers wrapped by them, each once."""
+    import tensorflow as tf
+
+    visited = set()
+    layers = list(model.layers)
+    while layers:
+        layer = layers.pop()
+        if id(layer) in visited:
+            continue
+        visited.add(id(layer))
+
         if isinstance(layer, tf.keras.layers.Wrapper):
-            _recursive_set_layer_mode(layer.layer, mode)
+            layers.append(layer.layer)
+        yield layer
 
-        config = layer.get_config()
-        # for every layer set mode, if it has it
-        if "mode" in config:
-            layer.mode = mode
-            # with any mode of inference - training is False
-        if "training" in config:
-            layer.training = False
-        if mode == modes.Modes.NON_STREAM_INFERENCE:
-            if "unroll" in config:
-                layer.unroll = True
 
-    for layer in model.layers:
-        _recursive_set_layer_mode(layer, mode)
+def _set_mode(model, mode):
+    """Set model's inference type and disable training."""
+    # with any mode of inference - training is False
+    mode_values = {"mode": mode, "training": False}
+    if mode == modes.Modes.NON_STREAM_INFERENCE:
+        mode_values["unroll"] = True
+
+    # attribute lookups are used instead of get_config(), which copies the config
+    for layer in _iter_layers(model):
+        # for every layer set mode, if it has it
+        for name in _MODE_ATTRIBUTES:
+            if name in mode_values and hasattr(layer, name):
+                setattr(layer, name, mode_values[name])
     return model
 
 
@@ -54,109 +76,106 @@ def _get_input_output_states(model):
     """Get input/output states of model with external states."""
     input_states = []
     output_states = []
-    for i in range(len(model.layers)):
-        config = model.layers[i].get_config()
-        # input output states exist only in layers with property 'mode'
-        if "mode" in config:
-            input_state = model.layers[i].get_input_state()
+    for layer in model.layers:
+        # input output states exist only in streaming layers
+        if hasattr(layer, "get_input_state"):
+            input_state = layer.get_input_state()
             if input_state not in ([], [None]):
-                input_states.append(model.layers[i].get_input_state())
-            output_state = model.layers[i].get_output_state()
+                input_states.append(input_state)
+            output_state = layer.get_output_state()
             if output_state not in ([], [None]):
                 output_states.append(output_state)
     return input_states, output_states
 
 
+def _assign_weights(dst, src):
+    """Assigns src's variables to dst's on device, without a numpy round trip."""
+    if len(dst.weights) != len(src.weights):
+        raise ValueError(
+            "number of weights in dst: %d != to weights number in src: %d "
+            % (len(dst.weights), len(src.weights))
+        )
+    for dst_weight, src_weight in zip(dst.weights, src.weights):
+        dst_weight.assign(src_weight)
+
+
 def _copy_weights(new_model, model):
     """Copy weights of trained model to an inference one."""
 
-    def _same_weights(weight, new_weight):
-        # Check that weights are the same
+    def _weight_key(weight):
+        # Weights are the same if they share name suffix, shape and trainability
         # Note that states should be marked as non trainable
         return (
-            weight.trainable == new_weight.trainable
-            and weight.shape == new_weight.shape
-            and weight.name[weight.name.rfind("/") : None]
-            == new_weight.name[new_weight.name.rfind("/") : None]
+            weight.name[weight.name.rfind("/") : None],
+            tuple(weight.shape),
+            weight.trainable,
         )
 
-    if len(new_model.layers) != len(model.layers):
+    layers = model.layers
+    new_layers = new_model.layers
+    if len(new_layers) != len(layers):
         raise ValueError(
             "number of layers in new_model: %d != to layers number in model: %d "
-            % (len(new_model.layers), len(model.layers))
+            % (len(new_layers), len(layers))
         )
 
-    for i in range(len(model.layers)):
-        layer = model.layers[i]
-        new_layer = new_model.layers[i]
+    for layer, new_layer in zip(layers, new_layers):
+        weights = layer.weights
+        new_layer_weights = new_layer.weights
+
+        # most layers (activations, reshapes, ...) have no weights to copy
+        if not weights and not new_layer_weights:
+            continue
 
         # if number of weights in the layers are the same
-        # then we can set weights directly
-        if len(layer.get_weights()) == len(new_layer.get_weights()):
-            new_layer.set_weights(layer.get_weights())
-        elif layer.weights:
-            k = 0  # index pointing to weights in the copied model
-            new_weights = []
-            # iterate over weights in the new_model
-            # and prepare a new_weights list which will
-            # contain weights from model and weight states from new model
-            for k_new in range(len(new_layer.get_weights())):
-                new_weight = new_layer.weights[k_new]
-                new_weight_values = new_layer.get_weights()[k_new]
-                same_weights = True
-
-                # if there are weights which are not copied yet
-                if k < len(layer.get_weights()):
-                    weight = layer.weights[k]
-                    weight_values = layer.get_weights()[k]
-                    if (
-                        weight.shape != weight_values.shape
-                        or new_weight.shape != new_weight_values.shape
-                    ):
-                        raise ValueError("weights are not listed in order")
-
-                    # if there are weights available for copying and they are the same
-                    if _same_weights(weight, new_weight):
-                        new_weights.append(weight_values)
-                        k = k + 1  # go to next weight in model
-                    else:
-                        same_weights = False  # weights are different
-                else:
-                    same_weights = (
-                        False  # all weights are copied, remaining is different
-                    )
-
-                if not same_weights:
-                    # weight with index k_new is missing in model,
-                    # so we will keep iterating over k_new until find similar weights
-                    new_weights.append(new_weight_values)
+        # then we can assign weights directly
+        if len(weights) == len(new_layer_weights):
+            _assign_weights(new_layer, layer)
+        elif weights:
+            # index weights of the trained model by key, keeping their order
+            # in case several weights share the same key
+            weight_index = {}
+            for weight in weights:
+                weight_index.setdefault(_weight_key(weight), deque()).append(weight)
+
+            # iterate over weights in the new_model and assign the matching
+            # weights from model, weights missing in model (e.g. streaming states)
+            # keep the values of the new model
+            k = 0  # number of weights copied from the trained model
+            for new_weight in new_layer_weights:
+                matched_weights = weight_index.get(_weight_key(new_weight))
+                if matched_weights:
+                    new_weight.assign(matched_weights.popleft())
+                    k = k + 1
 
             # check that all weights from model are copied to a new_model
-            if k != len(layer.get_weights()):
+            if k != len(weights):
                 raise ValueError(
                     "trained model has: %d weights, but only %d were copied"
-                    % (len(layer.get_weights()), k)
+                    % (len(weights), k)
                 )
-
-            # now they should have the same number of weights with matched sizes
-            # so we can set weights directly
-            new_layer.set_weights(new_weights)
     return new_model
 
 
+def _iter_nested_sequence(sequence):
+    """Yields sequence's elements, walking nested lists and tuples in order."""
+    stack = deque([sequence])
+    while stack:
+        value = stack.popleft()
+        if isinstance(value, (list, tuple)):
+            stack.extendleft(reversed(value))
+        else:
+            yield value
+
+
 def _flatten_nested_sequence(sequence):
     """Returns a flattened list of sequence's elements."""
-    if not isinstance(sequence, Sequence):
-        return [sequence]
-    result = []
-    for value in sequence:
-        result.extend(_flatten_nested_sequence(value))
-    return result
+    return list(_iter_nested_sequence(sequence))
 
 
 def _get_state_shapes(model_states):
     """Converts a nested list of states in to a flat list of their shapes."""
-    return [state.shape for state in _flatten_nested_sequence(model_states)]
+    return [state.shape for state in _iter_nested_sequence(model_states)]
 
 
 def save_model_summary(model, path, file_name="model_summary.txt"):
@@ -167,13 +186,10 @@ def save_model_summary(model, path, file_name="model_summary.txt"):
       path: path where to store model summary
       file_name: model summary file name
     """
+    import tensorflow as tf
+
     with tf.io.gfile.GFile(os.path.join(path, file_name), "w") as fd:
-        stringlist = []
-        model.summary(
-            print_fn=lambda x: stringlist.append(x)
-        )  # pylint: disable=unnecessary-lambda
-        model_summary = "\n".join(stringlist)
-        fd.write(model_summary)
+        model.summary(print_fn=lambda x: fd.write(x + "\n"))
 
 
 def convert_to_inference_model(model, input_tensors, mode):
@@ -196,6 +212,7 @@ def convert_to_inference_model(model, input_tensors, mode):
     Raises:
         ValueError: in case of invalid `model` argument value or input_tensors
     """
+    import tensorflow as tf
 
     # scope is introduced for simplifiyng access to weights by names
     scope_name = "streaming"
@@ -236,11 +253,11 @@ def convert_to_inference_model(model, input_tensors, mode):
 
         # inference streaming model with external states
         # has the same number of weights with
-        # non streaming model so we can use set_weights directly
-        new_streaming_model.set_weights(model.get_weights())
+        # non streaming model so we can assign weights directly
+        _assign_weights(new_streaming_model, model)
         return new_streaming_model
     elif mode == modes.Modes.NON_STREAM_INFERENCE:
-        new_model.set_weights(model.get_weights())
+        _assign_weights(new_model, model)
         return new_model
     else:
         raise ValueError("non supported mode ", mode)
@@ -258,6 +275,8 @@ def to_streaming_inference(model_non_stream, config, mode):
     Returns:
       Keras inference model of inference_type
     """
+    import tensorflow as tf
+
     # tf.keras.backend.set_learning_phase(0)
     input_data_shape = modes.get_input_data_shape(config, mode)
 
@@ -300,6 +319,7 @@ def model_to_saved(
     config,
     save_model_path,
     mode=modes.Modes.STREAM_INTERNAL_STATE_INFERENCE,
+    write_summary=False,
 ):
     """Convert Keras model to SavedModel.
 
@@ -313,6 +333,7 @@ def model_to_saved(
       save_model_path: path where saved model representation with be stored
       mode: inference mode it can be streaming with external state or non
         streaming
+      write_summary: whether to also save the model summary in text format
     """
 
     if mode not in (
@@ -327,53 +348,154 @@ def model_to_saved(
         # convert non streaming Keras model to Keras streaming model, internal state
         model = to_streaming_inference(model_non_stream, config, mode)
 
-    save_model_summary(model, save_model_path)
+    if write_summary:
+        save_model_summary(model, save_model_path)
     model.save(save_model_path, include_optimizer=False, save_format="tf")
 
 
+def _get_representative_frames(config, audio_processor):
+    """Returns spectrogram frames for quantization calibration, loading them once.
+
+    Whole spectrograms are kept in time order, as the streaming states are
+    calibrated on consecutive frames. The frames are cached per audio processor and
+    spectrogram length, as loading the features is the costly part of quantized
+    conversion.
+
+    Args:
+      config: dictionary containing training parameters
+      audio_processor: data processor used to load the training features
+
+    Returns:
+      float32 array of shape (frames, features)
+    """
+    cached_frames = _REPRESENTATIVE_FRAMES_CACHE.setdefault(audio_processor, {})
+    if config["spectrogram_length"] not in cached_frames:
+        # training mode already draws random clips
+        sample_fingerprints, _, _ = audio_processor.get_data(
+            "training",
+            REPRESENTATIVE_CLIP_COUNT,
+            features_length=config["spectrogram_length"],
+        )
+
+        # cast while concatenating, so no intermediate copy in the source dtype
+        all_frames = np.concatenate(
+            [
+                spectrogram.reshape(-1, spectrogram.shape[-1])
+                for spectrogram in sample_fingerprints
+            ],
+            dtype=np.float32,
+        )
+
+        cached_frames[config["spectrogram_length"]] = all_frames
+    return cached_frames[config["spectrogram_length"]]
+
+
 # Converts the saved model to tflite
 #   - If specified, will quantize using several positive and negative validation samples
 def convert_saved_model_to_tflite(
     config, audio_processor, path_to_model, folder, fname, quantize=False
 ):
+    import tensorflow as tf
+
     if not os.path.exists(folder):
         os.makedirs(folder)
 
-    sample_fingerprints, _, _ = audio_processor.get_data(
-        "training", 500, features_length=config["spectrogram_length"]
-    )
-
-    sample_fingerprints[0][0, 0] = 0.0  # guarantee one pixel is the preprocessor min
-    sample_fingerprints[0][0, 1] = 26.0  # guarantee one pixel is the preprocessor max
-
-    def representative_dataset_gen():
-        for spectrogram in sample_fingerprints:
-            for i in range(spectrogram.shape[0]):
-                yield [spectrogram[i, :].astype(np.float32)]
-
     converter = tf.compat.v2.lite.TFLiteConverter.from_saved_model(path_to_model)
     converter.experimental_new_quantizer = True
     converter.experimental_enable_resource_variables = True
     converter.experimental_new_converter = True
     converter._experimental_variable_quantization = True
-    converter.optimizations = [tf.lite.Optimize.DEFAULT]
 
     if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
         converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
 
         converter.inference_type = tf.int8
         converter.inference_input_type = tf.int8
         converter.inference_output_type = tf.uint8
 
+        all_frames = _get_representative_frames(config, audio_processor)
+
+        # guarantee one pixel is the preprocessor min and one is the preprocessor
+        # max, without modifying the cached frames
+        min_max_frame = all_frames[0].copy()
+        min_max_frame[:2] = (0.0, 26.0)
+
+        def representative_dataset_gen():
+            yield [min_max_frame]
+            for i in range(1, all_frames.shape[0]):
+                yield [all_frames[i]]
+
         converter.representative_dataset = representative_dataset_gen
 
     tflite_model = converter.convert()
     path_to_output = os.path.join(folder, fname)
-    open(path_to_output, "wb").write(tflite_model)
+    with tf.io.gfile.GFile(path_to_output, "wb") as fd:
+        fd.write(tflite_model)
+
+
+def _get_weights_mtime(weights_path):
+    """Returns the modification time of a checkpoint or a single weights file."""
+    index_path = weights_path + ".index"
+    if os.path.exists(index_path):
+        return os.path.getmtime(index_path)
+    return os.path.getmtime(weights_path)
+
+
+def _get_layer_modes(model):
+    """Returns the layer attributes which _set_mode changes, with their values."""
+    layer_modes = []
+    for layer in _iter_layers(model):
+        for name in _MODE_ATTRIBUTES:
+            if hasattr(layer, name):
+                layer_modes.append((layer, name, getattr(layer, name)))
+    return layer_modes
+
+
+def _restore_layer_modes(layer_modes):
+    """Restores layer attributes returned by _get_layer_modes."""
+    for layer, name, value in layer_modes:
+        setattr(layer, name, value)
+
+
+@functools.lru_cache(maxsize=2)
+def _load_trained_model(weights_path, weights_mtime, flags_json, config_json):
+    """Builds the model and loads its trained weights, once per set of arguments.
+
+    Exporting several inference modes of the same model reuses the loaded model
+    instead of rebuilding it and parsing the checkpoint again. flags and config are
+    passed as JSON strings so they can be used as cache keys.
+
+    Args:
+      weights_path: path to the trained model weights
+      weights_mtime: modification time of the weights, so rewritten weights are
+        loaded again
+      flags_json: JSON encoded model and data settings
+      config_json: JSON encoded dictionary containing training parameters
+
+    Returns:
+      Keras model with trained weights
+    """
+    import microwakeword.inception as inception
+
+    flags = argparse.Namespace(**json.loads(flags_json))
+    config = json.loads(config_json)
+
+    model = inception.model(flags, config)
+    model.load_weights(weights_path).expect_partial()
+    return model
 
 
 # Saves model with specified weights to disk
-def convert_model_saved(flags, config, folder, mode, weights_name="best_weights"):
+def convert_model_saved(
+    flags,
+    config,
+    folder,
+    mode,
+    weights_name="best_weights",
+    write_summary=False,
+    keep_model=False,
+):
     """Convert model to streaming and non streaming SavedModel.
 
     Args:
@@ -381,21 +503,41 @@ def convert_model_saved(flags, config, folder, mode, weights_name="best_weights"
         folder: folder where converted model will be saved
         mode: inference mode
         weights_name: file name with model weights
+        write_summary: whether to also save the model summary in text format
+        keep_model: whether to keep the trained model cached for a following
+          export, otherwise it is released once this export is done
     """
     old_batch_size = config["batch_size"]
     config["batch_size"] = 1  # set batch size for inference
 
-    model = inception.model(flags, config)
-    model.load_weights(os.path.join(config["train_dir"], weights_name)).expect_partial()
+    weights_path = os.path.join(config["train_dir"], weights_name)
+    model = _load_trained_model(
+        weights_path,
+        _get_weights_mtime(weights_path),
+        json.dumps(vars(flags), sort_keys=True),
+        json.dumps(config, sort_keys=True),
+    )
+    # the model is cached, so the layer modes changed by the conversion are
+    # restored afterwards
+    layer_modes = _get_layer_modes(model)
 
     path_model = os.path.join(config["train_dir"], folder)
     if not os.path.exists(path_model):
         os.makedirs(path_model)
     try:
         # convert trained model to SavedModel
-        model_to_saved(model, config, path_model, mode)
+        model_to_saved(model, config, path_model, mode, write_summary=write_summary)
     except IOError as e:
         logging.warning("FAILED to write file: %s", e)
     except (ValueError, AttributeError, RuntimeError, TypeError, AssertionError) as e:
         logging.warning("WARNING: failed to convert to SavedModel: %s", e)
+    finally:
+        _restore_layer_modes(layer_modes)
+
+    if not keep_model:
+        # release the trained model's variables before the next conversion step
+        del model, layer_modes
+        _load_trained_model.cache_clear()
+        gc.collect()
+
     config["batch_size"] = old_batch_size